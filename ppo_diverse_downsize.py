@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.distributions.categorical import Categorical
 from torch.utils.tensorboard import SummaryWriter
 
 import argparse
@@ -17,6 +16,7 @@ from gym.wrappers import TimeLimit, Monitor
 from gym.spaces import Discrete, Box, MultiBinary, MultiDiscrete, Space
 from stable_baselines3.common.vec_env import VecEnvWrapper, VecVideoRecorder
 import time
+import contextlib
 import random
 import os
 import wandb
@@ -56,6 +56,13 @@ def parse_args():
         nargs="?",
         const=True,
     )
+    parser.add_argument(
+        "--render",
+        type=lambda x: bool(strtobool(x)),
+        default=False,
+        nargs="?",
+        const=True,
+    )
     parser.add_argument("--wandb-project-name", type=str, default="cleanRL")
     parser.add_argument("--wandb-entity", type=str, default=None)
     # Algorithm specific
@@ -108,6 +115,13 @@ def parse_args():
         nargs="?",
         const=True,
     )
+    parser.add_argument(
+        "--bf16-update",
+        type=lambda x: bool(strtobool(x)),
+        default=False,
+        nargs="?",
+        const=True,
+    )
 
     args = parser.parse_args()
     if not args.seed:
@@ -128,6 +142,11 @@ def set_environment(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    # input shapes are fixed, let cudnn autotune the conv kernels unless results must be reproducible
+    torch.backends.cudnn.benchmark = not args.torch_deterministic
+    # allow TF32 for the fp32 matmuls that remain outside bf16 autocast
+    if hasattr(torch, "set_float32_matmul_precision"):
+        torch.set_float32_matmul_precision("high")
     # envs
     envs = MicroRTSVecEnv(
         num_envs=args.num_envs,
@@ -177,11 +196,15 @@ class VecMonitor(VecEnvWrapper):
         self.eplens = None
         self.epcount = 0
         self.tstart = time.time()
+        # (env index, info) of the episodes finished by the last step, so callers can
+        # skip scanning every info dict for an 'episode' key
+        self.last_episode_infos = []
 
     def reset(self):
         obs = self.venv.reset()
         self.eprets = np.zeros(self.num_envs, 'f')
         self.eplens = np.zeros(self.num_envs, 'i')
+        self.last_episode_infos = []
         return obs
 
     def step_wait(self):
@@ -189,7 +212,9 @@ class VecMonitor(VecEnvWrapper):
         self.eprets += rews
         self.eplens += 1
 
-        newinfos = list(infos[:])
+        self.last_episode_infos = []
+        # the per-env info dicts of finished episodes are replaced in the venv's own infos list;
+        # everything downstream only reads it, so no per-step copy of the list is made
         for i in range(len(dones)):
             if dones[i]:
                 info = infos[i].copy()
@@ -200,28 +225,70 @@ class VecMonitor(VecEnvWrapper):
                 self.epcount += 1
                 self.eprets[i] = 0
                 self.eplens[i] = 0
-                newinfos[i] = info
-        return obs, rews, dones, newinfos
+                infos[i] = info
+                self.last_episode_infos.append((i, info))
+        return obs, rews, dones, infos
 
 
 class VecPyTorch(VecEnvWrapper):
     def __init__(self, venv, device):
         super(VecPyTorch, self).__init__(venv)
         self.device = device
+        # persistent host staging buffers; pinned so the H2D copies can run non_blocking.
+        # observations are 0/1 feature planes and travel (and are stored) as uint8
+        self._copy_done = None
+        if torch.cuda.is_available() and torch.device(device).type == "cuda":
+            self._obs_pinned = torch.empty(
+                (self.num_envs,) + self.observation_space.shape, dtype=torch.uint8, pin_memory=True
+            )
+            self._rew_pinned = torch.empty((self.num_envs, 1), dtype=torch.float32, pin_memory=True)
+            self._done_pinned = torch.empty((self.num_envs,), dtype=torch.float32, pin_memory=True)
+            self._copy_done = torch.cuda.Event()
+            # actions come back through one reused pinned buffer, allocated on the first step
+            self._action_pinned = None
+            self._action_done = torch.cuda.Event()
+
+    def _stage(self, obs, reward=None, done=None):
+        if self._copy_done is None:
+            obs = torch.from_numpy(obs.astype(np.uint8)).to(self.device)
+            if reward is not None:
+                reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+                done = torch.as_tensor(done, dtype=torch.float32, device=self.device)
+            return obs, reward, done
+        # the previous async copy must have left the staging buffers before they are overwritten
+        self._copy_done.synchronize()
+        np.copyto(self._obs_pinned.numpy(), obs, casting="unsafe")
+        obs = self._obs_pinned.to(self.device, non_blocking=True)
+        if reward is not None:
+            np.copyto(self._rew_pinned.numpy(), reward[:, None])
+            reward = self._rew_pinned.to(self.device, non_blocking=True)
+            np.copyto(self._done_pinned.numpy(), done)
+            done = self._done_pinned.to(self.device, non_blocking=True)
+        self._copy_done.record()
+        return obs, reward, done
 
     def reset(self):
         obs = self.venv.reset()
-        obs = torch.from_numpy(obs).float().to(self.device)
+        obs, _, _ = self._stage(obs)
         return obs
 
     def step_async(self, actions):
-        actions = actions.cpu().numpy()
-        self.venv.step_async(actions)
+        if self._copy_done is None or actions.device.type != "cuda":
+            self.venv.step_async(actions.cpu().numpy())
+            return
+        if self._action_pinned is None:
+            self._action_pinned = torch.empty(actions.shape, dtype=actions.dtype, pin_memory=True)
+        # the venv holds on to the array until step_wait, which always runs before the next
+        # step_async, so overwriting the buffer here is safe
+        self._action_pinned.copy_(actions, non_blocking=True)
+        self._action_done.record()
+        self._action_done.synchronize()
+        self.venv.step_async(self._action_pinned.numpy())
 
     def step_wait(self):
+        # done comes back as a float32 tensor on self.device, like obs and reward
         obs, reward, done, info = self.venv.step_wait()
-        obs = torch.from_numpy(obs).float().to(self.device)
-        reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+        obs, reward, done = self._stage(obs, reward, done)
         return obs, reward, done, info
 
 
@@ -229,45 +296,57 @@ class MicroRTSStatsRecorder(VecEnvWrapper):
     def __init__(self, env, gamma):
         super().__init__(env)
         self.gamma = gamma
+        self.raw_names = [str(rf) for rf in self.rfs]
 
     def reset(self):
         obs = self.venv.reset()
-        self.raw_rewards = [[] for _ in range(self.num_envs)]
+        # running per-env sum of the raw reward components of the current episode
+        self.raw_rewards = np.zeros((self.num_envs, len(self.raw_names)), dtype=np.float32)
         return obs
 
     def step_wait(self):
         obs, rews, dones, infos = self.venv.step_wait()
         for i in range(len(dones)):
-            self.raw_rewards[i] += [infos[i]["raw_rewards"]] 
-        newinfos = list(infos[:])
+            self.raw_rewards[i] += infos[i]["raw_rewards"]
+        # updated in place, like in VecMonitor
         for i in range(len(dones)):
             if dones[i]:
                 info = infos[i].copy()
-                raw_rewards = np.array(self.raw_rewards[i]).sum(0)
-                raw_names = [str(rf) for rf in self.rfs]
-                info['microrts_stats'] = dict(zip(raw_names, raw_rewards))
-                self.raw_rewards[i] = []
-                newinfos[i] = info
-        return obs, rews, dones, newinfos
+                info['microrts_stats'] = dict(zip(self.raw_names, self.raw_rewards[i].tolist()))
+                self.raw_rewards[i] = 0
+                infos[i] = info
+        return obs, rews, dones, infos
 
 
 # ALGO LOGIC: initialize agent here:
-class CategoricalMasked(Categorical):
-    def __init__(self, probs=None, logits=None, validate_args=None, masks=[]):
-        self.masks = masks
-        if len(self.masks) == 0:
-            super(CategoricalMasked, self).__init__(probs, logits, validate_args)
-        else:
-            self.masks = masks.type(torch.BoolTensor).to(logits.device)
-            logits = torch.where(self.masks, logits, torch.tensor(-1e+8).to(logits.device))
-            super(CategoricalMasked, self).__init__(probs, logits, validate_args)
-    
-    def entropy(self):
-        if len(self.masks) == 0:
-            return super(CategoricalMasked, self).entropy()
-        p_log_p = self.logits * self.probs
-        p_log_p = torch.where(self.masks, p_log_p, torch.tensor(0.).to(self.logits.device))
-        return -p_log_p.sum(-1)
+@torch.jit.script
+def masked_entropy(logits, masks):
+    p = logits.softmax(-1)
+    return -(logits.masked_fill(~masks, 0.) * p).sum(-1)
+
+@torch.jit.script
+def padded_log_probs(logits, masks, pad_index, num_heads: int):
+    # logits/masks: [B, sum(nvec)]. The heads are laid out as one padded [B, num_heads, max(nvec)]
+    # block so a single log_softmax covers all of them; padded slots read an appended -inf logit
+    # (and False mask) and carry no probability mass. Masked logits are set to -1e8 rather than
+    # -inf so a head with no valid choice stays finite.
+    batch = logits.size(0)
+    logits = logits.masked_fill(~masks, -1e8)
+    logits = torch.cat([logits, torch.full_like(logits[:, :1], float("-inf"))], 1)
+    masks = torch.cat([masks, torch.zeros_like(masks[:, :1])], 1)
+    logits = logits.index_select(1, pad_index).view(batch, num_heads, -1)
+    masks = masks.index_select(1, pad_index).view(batch, num_heads, -1)
+    return F.log_softmax(logits, dim=-1), masks
+
+@torch.jit.script
+def log_prob_entropy(log_probs, masks, actions):
+    # log_probs/masks: [B, num_heads, max(nvec)] from `padded_log_probs`, actions: [B, num_heads]
+    logprob = log_probs.gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+    # a fully masked head has log_prob 0 under CategoricalMasked (float32 rounding of -1e8),
+    # not -log(n); keep that so logprobs and approx_kl match the other scripts
+    logprob = logprob.masked_fill(~masks.any(-1), 0.0).sum(-1)
+    entropy = masked_entropy(log_probs, masks).sum(-1)
+    return logprob, entropy
 
 class Scale(nn.Module):
     def __init__(self, scale):
@@ -282,6 +361,23 @@ def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
     torch.nn.init.constant_(layer.bias, bias_const)
     return layer
 
+def snapshot_parameters(module, flat):
+    # element-wise copy_ instead of parameters_to_vector, which needs contiguous (non channels_last) weights
+    offset = 0
+    with torch.no_grad():
+        for p in module.parameters():
+            n = p.numel()
+            flat[offset:offset + n].view_as(p).copy_(p)
+            offset += n
+
+def restore_parameters(module, flat):
+    offset = 0
+    with torch.no_grad():
+        for p in module.parameters():
+            n = p.numel()
+            p.copy_(flat[offset:offset + n].view_as(p))
+            offset += n
+
 class ResidualBlock(nn.Module):
     def __init__(self, channels):
         super().__init__()
@@ -336,56 +432,163 @@ class Agent(nn.Module):
             nn.Flatten(),
             nn.Linear(32 * ((h // 4) * (w // 4)), 128),  # Reduced from 256 to 128
             nn.ReLU(),
-        )
-        self.actor = layer_init(nn.Linear(128, envs.action_space.nvec.sum()), std=0.01)
+        ).to(memory_format=torch.channels_last)
+        # action-space layout is fixed, so resolve it once instead of on every get_action call
+        self._nvec_list = envs.action_space.nvec.tolist()
+        self._nvec_sum = int(envs.action_space.nvec.sum())
+        # the hot path is straight-line: the source-unit head is a fixed-width slice and the
+        # remaining heads go through the padded layout below, so nothing loops over heads per call
+        self._num_heads = len(self._nvec_list)
+        self._source_width = self._nvec_list[0]
+        self.actor = layer_init(nn.Linear(128, self._nvec_sum), std=0.01)
         self.critic = layer_init(nn.Linear(128, 1), std=1)
+        # flat-logit index of every slot of the padded [num_heads, max(nvec)] head layout;
+        # padding points one past the end, at the filler column padded_log_probs appends
+        pad_index = torch.full((len(self._nvec_list), max(self._nvec_list)), self._nvec_sum, dtype=torch.long)
+        offset = 0
+        for k, n in enumerate(self._nvec_list):
+            pad_index[k, :n] = torch.arange(offset, offset + n)
+            offset += n
+        self.register_buffer("_pad_index", pad_index.view(-1), persistent=False)
+        # reusable (pinned on cuda) host buffers: the source-unit head is sampled on the host, and
+        # both masks are written side by side into one buffer so they go to the device in one copy
+        pin = torch.cuda.is_available() and args.cuda
+        self._source_logits_host = torch.zeros((args.num_envs, self._source_width), pin_memory=pin)
+        self._source_action_host = torch.zeros((args.num_envs,), dtype=torch.long, pin_memory=pin)
+        self._mask_host = torch.zeros((args.num_envs, self._nvec_sum), dtype=torch.bool, pin_memory=pin)
 
     def forward(self, x):
-        return self.network(x.permute((0, 3, 1, 2))) # "bhwc" -> "bchw"
+        # "bhwc" -> "bchw"; the permuted view of a contiguous bhwc tensor already is channels_last,
+        # and the uint8 -> float cast keeps that layout
+        return self.network(x.permute((0, 3, 1, 2)).float().contiguous(memory_format=torch.channels_last))
 
     def get_action(self, x, action=None, invalid_action_masks=None, envs=None):
-        logits = self.actor(self.forward(x))
-        split_logits = torch.split(logits, envs.action_space.nvec.tolist(), dim=1)
-        
+        return self._action_from_hidden(self.forward(x), action, invalid_action_masks, envs)
+
+    def get_action_and_value(self, x, action=None, invalid_action_masks=None, envs=None):
+        # one trunk pass shared by the actor and the critic
+        hidden = self.forward(x)
+        return self._action_from_hidden(hidden, action, invalid_action_masks, envs) + (self.critic(hidden),)
+
+    def _action_from_hidden(self, hidden, action, invalid_action_masks, envs):
+        # sampling / log_prob / entropy always run in fp32, even under autocast
+        logits = self.actor(hidden).float()
+
         if action is None:
             # 1. select source unit based on source unit mask
-            source_unit_mask = torch.Tensor(np.array(envs.vec_client.getUnitLocationMasks()).reshape(self.args.num_envs, -1))
-            multi_categoricals = [CategoricalMasked(logits=split_logits[0], masks=source_unit_mask)]
-            action_components = [multi_categoricals[0].sample()]
+            # the host buffers are only refilled after the sync in step_async, so the previous
+            # non_blocking copies out of them have already completed
+            mask_host = self._mask_host.numpy()
+            np.copyto(
+                mask_host[:, :self._source_width],
+                np.asarray(envs.vec_client.getUnitLocationMasks(), dtype=np.bool_).reshape(self.args.num_envs, -1))
+            # the source unit has to come back to the host for getUnitActionMasks anyway, so its
+            # (small) head is downloaded and sampled there instead of syncing on a device sample
+            self._source_logits_host.copy_(logits[:, :self._source_width])
+            source_logits = self._source_logits_host.masked_fill(~self._mask_host[:, :self._source_width], -1e8)
+            source_action = torch.multinomial(F.softmax(source_logits, dim=-1), 1).squeeze(-1)
             # 2. select action type and parameter section based on the
             #    source-unit mask of action type and parameters
-            # print(np.array(envs.vec_client.getUnitActionMasks(action_components[0].cpu().numpy())).reshape(args.num_envs, -1))
-            source_unit_action_mask = torch.Tensor(
-                np.array(envs.vec_client.getUnitActionMasks(action_components[0].cpu().numpy())).reshape(self.args.num_envs, -1))
-            split_suam = torch.split(source_unit_action_mask, envs.action_space.nvec.tolist()[1:], dim=1)
-            multi_categoricals = multi_categoricals + [CategoricalMasked(logits=logits, masks=iam) for (logits, iam) in zip(split_logits[1:], split_suam)]
-            invalid_action_masks = torch.cat((source_unit_mask, source_unit_action_mask), 1)
-            action_components += [categorical.sample() for categorical in multi_categoricals[1:]]
-            action = torch.stack(action_components)
-        else:
-            split_invalid_action_masks = torch.split(invalid_action_masks, envs.action_space.nvec.tolist(), dim=1)
-            multi_categoricals = [CategoricalMasked(logits=logits, masks=iam) for (logits, iam) in zip(split_logits, split_invalid_action_masks)]
-        logprob = torch.stack([categorical.log_prob(a) for a, categorical in zip(action, multi_categoricals)])
-        entropy = torch.stack([categorical.entropy() for categorical in multi_categoricals])
-        return action, logprob.sum(0), entropy.sum(0), invalid_action_masks
+            # print(np.array(envs.vec_client.getUnitActionMasks(source_action.numpy())).reshape(args.num_envs, -1))
+            np.copyto(
+                mask_host[:, self._source_width:],
+                np.asarray(envs.vec_client.getUnitActionMasks(source_action.numpy()), dtype=np.bool_)
+                .reshape(self.args.num_envs, -1))
+            invalid_action_masks = self._mask_host.to(logits.device, non_blocking=True, copy=True)
+            self._source_action_host.copy_(source_action)
+            source_action = self._source_action_host.to(logits.device, non_blocking=True, copy=True)
+        log_probs, masks = padded_log_probs(logits, invalid_action_masks, self._pad_index, self._num_heads)
+        if action is None:
+            # the parameter heads are sampled straight from the padded log-probs that log_prob /
+            # entropy read below, in one multinomial call over all their rows
+            param_probs = log_probs[:, 1:].exp().reshape(-1, log_probs.size(-1))
+            param_action = torch.multinomial(param_probs, 1).view(log_probs.size(0), -1)
+            action = torch.cat((source_action.unsqueeze(1), param_action), 1).T
+        logprob, entropy = log_prob_entropy(log_probs, masks, action.T)
+        return action, logprob, entropy, invalid_action_masks
 
     def get_value(self, x):
         return self.critic(self.forward(x))
 
+@torch.jit.script
+def compute_gae(rewards, values, dones, last_value, next_done, gamma: float, lmbda: float):
+    # all inputs are [num_steps, num_envs]; reverse scan over time for every env at once.
+    # TorchScript runs the loop without the interpreter, and a plain recurrence never
+    # rescales by a (gamma*lmbda)^t factor that could underflow on long rollouts
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    nextvalues = torch.cat([values[1:], last_value.view(1, -1)], dim=0)
+    deltas = rewards + gamma * nextvalues * nextnonterminals - values
+    advantages = torch.empty_like(rewards)
+    lastgaelam = torch.zeros_like(rewards[0])
+    for t in range(num_steps - 1, -1, -1):
+        lastgaelam = deltas[t] + gamma * lmbda * nextnonterminals[t] * lastgaelam
+        advantages[t] = lastgaelam
+    return advantages, advantages + values
+
+@torch.jit.script
+def compute_returns(rewards, values, dones, last_value, next_done, gamma: float):
+    # same reverse scan without the lambda trace, for --gae false
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    returns = torch.empty_like(rewards)
+    next_return = last_value.view(-1)
+    for t in range(num_steps - 1, -1, -1):
+        next_return = rewards[t] + gamma * nextnonterminals[t] * next_return
+        returns[t] = next_return
+    return returns - values, returns
+
+@torch.jit.script
+def ppo_losses(newlogproba, logprobs, advantages, returns, values, new_values, entropy,
+               clip_coef: float, clip_vloss: bool, ent_coef: float, vf_coef: float):
+    ratio = (newlogproba - logprobs).exp()
+
+    # Stats
+    approx_kl = (logprobs - newlogproba).mean()
+
+    # Policy loss
+    pg_loss1 = -advantages * ratio
+    pg_loss2 = -advantages * torch.clamp(ratio, 1 - clip_coef, 1 + clip_coef)
+    pg_loss = torch.max(pg_loss1, pg_loss2).mean()
+    entropy_loss = entropy.mean()
+
+    # Value loss
+    if clip_vloss:
+        v_loss_unclipped = ((new_values - returns) ** 2)
+        v_clipped = values + torch.clamp(new_values - values, -clip_coef, clip_coef)
+        v_loss_clipped = (v_clipped - returns) ** 2
+        v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
+        v_loss = 0.5 * v_loss_max.mean()
+    else:
+        v_loss = 0.5 * ((new_values - returns) ** 2).mean()
+
+    loss = pg_loss - ent_coef * entropy_loss + v_loss * vf_coef
+    return loss, pg_loss, v_loss, entropy_loss, approx_kl
+
+def bf16_autocast(enabled):
+    if enabled:
+        return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
 def train(envs, agent, args, writer, device, run=None, CHECKPOINT_FREQUENCY=None, experiment_name=None):
+    # bf16 needs no GradScaler; torch.autocast / bf16 support only exist on newer torch + Ampere GPUs
+    use_bf16 = (
+        args.bf16_update and device.type == "cuda"
+        and hasattr(torch, "autocast") and torch.cuda.is_bf16_supported()
+    )
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
     if args.anneal_lr:
         # https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/ppo2/defaults.py#L20
         lr = lambda f: f * args.learning_rate
 
     # ALGO Logic: Storage for epoch data
-    obs = torch.zeros((args.num_steps, args.num_envs) + envs.observation_space.shape).to(device)
+    obs = torch.zeros((args.num_steps, args.num_envs) + envs.observation_space.shape, dtype=torch.uint8, device=device)
     actions = torch.zeros((args.num_steps, args.num_envs) + envs.action_space.shape).to(device)
     logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
     rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
     dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
     values = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    invalid_action_masks = torch.zeros((args.num_steps, args.num_envs) + (envs.action_space.nvec.sum(),)).to(device)
+    invalid_action_masks = torch.zeros((args.num_steps, args.num_envs) + (agent._nvec_sum,), dtype=torch.bool, device=device)
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
@@ -394,6 +597,19 @@ def train(envs, agent, args, writer, device, run=None, CHECKPOINT_FREQUENCY=None
     next_obs = envs.reset()
     next_done = torch.zeros(args.num_envs).to(device)
     num_updates = args.total_timesteps // args.batch_size
+    # kle_rollback only needs the pre-epoch weights: keep them in one flat buffer instead of a second Agent
+    param_snapshot = None
+    if args.kle_rollback:
+        param_snapshot = torch.empty(sum(p.numel() for p in agent.parameters()), device=device)
+    # minibatches are gathered with index_select(out=...) into these reusable buffers
+    mb_shape = (args.minibatch_size,)
+    mb_obs_buf = torch.empty(mb_shape + envs.observation_space.shape, dtype=torch.uint8, device=device)
+    mb_actions_buf = torch.empty(mb_shape + envs.action_space.shape, dtype=torch.long, device=device)
+    mb_masks_buf = torch.empty(mb_shape + (agent._nvec_sum,), dtype=torch.bool, device=device)
+    mb_logprobs_buf = torch.empty(mb_shape, device=device)
+    mb_advantages_buf = torch.empty(mb_shape, device=device)
+    mb_returns_buf = torch.empty(mb_shape, device=device)
+    mb_values_buf = torch.empty(mb_shape, device=device)
     ## CRASH AND RESUME LOGIC:
     starting_update = 1
     if args.prod_mode and wandb.run.resumed:
@@ -415,109 +631,79 @@ def train(envs, agent, args, writer, device, run=None, CHECKPOINT_FREQUENCY=None
 
         # TRY NOT TO MODIFY: prepare the execution of the game.
         for step in range(0, args.num_steps):
-            envs.render()
+            if args.render:
+                envs.render()
             global_step += 1 * args.num_envs
             obs[step] = next_obs
             dones[step] = next_done
 
             # ALGO LOGIC: put action logic here
             with torch.no_grad():
-                values[step] = agent.get_value(obs[step]).flatten()
-                action, logproba, _, invalid_action_masks[step] = agent.get_action(obs[step], envs=envs)
+                action, logproba, _, invalid_action_masks[step], value = agent.get_action_and_value(obs[step], envs=envs)
+                values[step] = value.flatten()
 
             actions[step] = action.T
             logprobs[step] = logproba
 
             # TRY NOT TO MODIFY: execute the game and log data.
             next_obs, rs, ds, infos = envs.step(action.T)
-            rewards[step], next_done = rs.view(-1), torch.Tensor(ds).to(device)
-
-            for info in infos:
-                if 'episode' in info.keys():
-                    print(f"global_step={global_step}, episode_reward={info['episode']['r']}")
-                    writer.add_scalar("charts/episode_reward", info['episode']['r'], global_step)
-                    for key in info['microrts_stats']:
-                        writer.add_scalar(f"charts/episode_reward/{key}", info['microrts_stats'][key], global_step)
-                    break
+            rewards[step], next_done = rs.view(-1), ds
+
+            if envs.last_episode_infos:
+                _, info = envs.last_episode_infos[0]
+                print(f"global_step={global_step}, episode_reward={info['episode']['r']}")
+                writer.add_scalar("charts/episode_reward", info['episode']['r'], global_step)
+                for key in info['microrts_stats']:
+                    writer.add_scalar(f"charts/episode_reward/{key}", info['microrts_stats'][key], global_step)
 
         # bootstrap reward if not done. reached the batch limit
         with torch.no_grad():
             last_value = agent.get_value(next_obs.to(device)).reshape(1, -1)
             if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        nextvalues = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t+1]
-                        nextvalues = values[t+1]
-                    delta = rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                    advantages[t] = lastgaelam = delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                returns = advantages + values
+                advantages, returns = compute_gae(
+                    rewards, values, dones, last_value, next_done, args.gamma, args.gae_lambda)
             else:
-                returns = torch.zeros_like(rewards).to(device)
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        next_return = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t+1]
-                        next_return = returns[t+1]
-                    returns[t] = rewards[t] + args.gamma * nextnonterminal * next_return
-                advantages = returns - values
+                advantages, returns = compute_returns(
+                    rewards, values, dones, last_value, next_done, args.gamma)
 
         # flatten the batch
         b_obs = obs.reshape((-1,)+envs.observation_space.shape)
         b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,)+envs.action_space.shape)
+        b_actions = actions.reshape((-1,)+envs.action_space.shape).long()
         b_advantages = advantages.reshape(-1)
         b_returns = returns.reshape(-1)
         b_values = values.reshape(-1)
         b_invalid_action_masks = invalid_action_masks.reshape((-1, invalid_action_masks.shape[-1]))
 
         # Optimizaing the policy and value network
-        target_agent = Agent().to(device)
-        inds = np.arange(args.batch_size,)
         for i_epoch_pi in range(args.update_epochs):
-            np.random.shuffle(inds)
-            target_agent.load_state_dict(agent.state_dict())
+            inds = torch.randperm(args.batch_size, device=device)
+            if args.kle_rollback:
+                snapshot_parameters(agent, param_snapshot)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 minibatch_ind = inds[start:end]
-                mb_advantages = b_advantages[minibatch_ind]
+                n = minibatch_ind.numel()
+                mb_obs = torch.index_select(b_obs, 0, minibatch_ind, out=mb_obs_buf[:n])
+                mb_actions = torch.index_select(b_actions, 0, minibatch_ind, out=mb_actions_buf[:n])
+                mb_masks = torch.index_select(b_invalid_action_masks, 0, minibatch_ind, out=mb_masks_buf[:n])
+                mb_logprobs = torch.index_select(b_logprobs, 0, minibatch_ind, out=mb_logprobs_buf[:n])
+                mb_advantages = torch.index_select(b_advantages, 0, minibatch_ind, out=mb_advantages_buf[:n])
+                mb_returns = torch.index_select(b_returns, 0, minibatch_ind, out=mb_returns_buf[:n])
+                mb_values = torch.index_select(b_values, 0, minibatch_ind, out=mb_values_buf[:n])
                 if args.norm_adv:
                     mb_advantages = (mb_advantages - mb_advantages.mean()) / (mb_advantages.std() + 1e-8)
 
-                _, newlogproba, entropy, _ = agent.get_action(
-                    b_obs[minibatch_ind],
-                    b_actions.long()[minibatch_ind].T,
-                    b_invalid_action_masks[minibatch_ind],
-                    envs)
-                ratio = (newlogproba - b_logprobs[minibatch_ind]).exp()
-
-                # Stats
-                approx_kl = (b_logprobs[minibatch_ind] - newlogproba).mean()
-
-                # Policy loss
-                pg_loss1 = -mb_advantages * ratio
-                pg_loss2 = -mb_advantages * torch.clamp(ratio, 1-args.clip_coef, 1+args.clip_coef)
-                pg_loss = torch.max(pg_loss1, pg_loss2).mean()
-                entropy_loss = entropy.mean()
-
-                # Value loss
-                new_values = agent.get_value(b_obs[minibatch_ind]).view(-1)
-                if args.clip_vloss:
-                    v_loss_unclipped = ((new_values - b_returns[minibatch_ind]) ** 2)
-                    v_clipped = b_values[minibatch_ind] + torch.clamp(new_values - b_values[minibatch_ind], -args.clip_coef, args.clip_coef)
-                    v_loss_clipped = (v_clipped - b_returns[minibatch_ind])**2
-                    v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
-                    v_loss = 0.5 * v_loss_max.mean()
-                else:
-                    v_loss = 0.5 *((new_values - b_returns[minibatch_ind]) ** 2)
-
-                loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
+                with bf16_autocast(use_bf16):
+                    _, newlogproba, entropy, _, new_values = agent.get_action_and_value(
+                        mb_obs,
+                        mb_actions.T,
+                        mb_masks,
+                        envs)
+                new_values = new_values.view(-1).float()
+                loss, pg_loss, v_loss, entropy_loss, approx_kl = ppo_losses(
+                    newlogproba, mb_logprobs, mb_advantages, mb_returns, mb_values, new_values, entropy,
+                    args.clip_coef, args.clip_vloss, args.ent_coef, args.vf_coef)
 
                 optimizer.zero_grad()
                 loss.backward()
@@ -528,12 +714,15 @@ def train(envs, agent, args, writer, device, run=None, CHECKPOINT_FREQUENCY=None
                 if approx_kl > args.target_kl:
                     break
             if args.kle_rollback:
-                if (b_logprobs[minibatch_ind] - agent.get_action(
-                        b_obs[minibatch_ind],
-                        b_actions.long()[minibatch_ind].T,
-                        b_invalid_action_masks[minibatch_ind],
-                        envs)[1]).mean() > args.target_kl:
-                    agent.load_state_dict(target_agent.state_dict())
+                with torch.no_grad():
+                    # the minibatch buffers still hold the last minibatch of the epoch
+                    kl_rollback = (mb_logprobs - agent.get_action(
+                        mb_obs,
+                        mb_actions.T,
+                        mb_masks,
+                        envs)[1]).mean()
+                if kl_rollback > args.target_kl:
+                    restore_parameters(agent, param_snapshot)
                     break
 
         ## CRASH AND RESUME LOGIC:
@@ -19,6 +19,9 @@ from gym.spaces import Discrete, Box, MultiBinary, MultiDiscrete, Space
 import time
 import random
 import os
+import concurrent.futures
+import contextlib
+import inspect
 from stable_baselines3.common.vec_env import VecEnvWrapper, VecVideoRecorder
 
 
@@ -112,6 +115,30 @@ def set_environment():
         nargs="?",
         const=True,
     )
+    parser.add_argument(
+        "--cuda-graph",
+        type=lambda x: bool(strtobool(x)),
+        default=True,
+        nargs="?",
+        const=True,
+        help="replay the rollout forward from a captured CUDA graph",
+    )
+    parser.add_argument(
+        "--compile",
+        type=lambda x: bool(strtobool(x)),
+        default=False,
+        nargs="?",
+        const=True,
+        help="compile the backbone and heads with torch.compile (torch >= 2.2)",
+    )
+    parser.add_argument(
+        "--bf16",
+        type=lambda x: bool(strtobool(x)),
+        default=False,
+        nargs="?",
+        const=True,
+        help="run the network forward/backward under bf16 autocast on supported GPUs",
+    )
 
     args = parser.parse_args()
     if not args.seed:
@@ -130,6 +157,9 @@ def set_environment():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.backends.cudnn.deterministic = args.torch_deterministic
+    # allow TF32 for whatever fp32 matmuls remain outside autocast
+    if hasattr(torch, "set_float32_matmul_precision"):
+        torch.set_float32_matmul_precision("high")
 
     # Environment
     envs = MicroRTSVecEnv(
@@ -201,21 +231,21 @@ class VecMonitor(VecEnvWrapper):
         self.eplens += 1
 
         newinfos = list(infos[:])
-        for i in range(len(dones)):
-            if dones[i]:
-                info = infos[i].copy()
-                ret = self.eprets[i]
-                eplen = self.eplens[i]
-                epinfo = {
-                    "r": ret,
-                    "l": eplen,
-                    "t": round(time.time() - self.tstart, 6),
-                }
-                info["episode"] = epinfo
-                self.epcount += 1
-                self.eprets[i] = 0
-                self.eplens[i] = 0
-                newinfos[i] = info
+        done_idx = np.flatnonzero(dones)
+        for i in done_idx:
+            info = infos[i].copy()
+            ret = self.eprets[i]
+            eplen = self.eplens[i]
+            epinfo = {
+                "r": ret,
+                "l": eplen,
+                "t": round(time.time() - self.tstart, 6),
+            }
+            info["episode"] = epinfo
+            newinfos[i] = info
+        self.epcount += len(done_idx)
+        self.eprets[done_idx] = 0
+        self.eplens[done_idx] = 0
         return obs, rews, dones, newinfos
 
 
@@ -223,20 +253,76 @@ class VecPyTorch(VecEnvWrapper):
     def __init__(self, venv, device):
         super(VecPyTorch, self).__init__(venv)
         self.device = device
+        # on cuda, obs/reward are staged in pinned host buffers so the host-to-device copy
+        # is an async DMA that overlaps with whatever the GPU is still running. The obs are
+        # 0/1 feature planes, so they travel as uint8 and are cast to float by the Agent
+        self._pinned = torch.cuda.is_available() and torch.device(device).type == "cuda"
+        if self._pinned:
+            self._obs_pinned = torch.empty(
+                (self.num_envs,) + self.observation_space.shape, dtype=torch.uint8
+            ).pin_memory()
+            self._rew_pinned = torch.empty(
+                (self.num_envs, 1), dtype=torch.float32
+            ).pin_memory()
+            self._done_pinned = torch.empty(
+                (self.num_envs,), dtype=torch.float32
+            ).pin_memory()
+            self._copied = torch.cuda.Event()
+        # the (JNI) env step runs on a worker thread between step_async and step_wait, so
+        # the caller can keep feeding the GPU while the JVM simulates
+        self._stepper = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_step = None
+
+    def _stage(self, obs, reward=None, done=None):
+        # host half of the transfer: fill the pinned buffers (nothing to do without cuda)
+        if self._pinned:
+            # the buffers may only be refilled once the previous copy out of them is done
+            self._copied.synchronize()
+            np.copyto(self._obs_pinned.numpy(), obs, casting="unsafe")
+            if reward is not None:
+                np.copyto(self._rew_pinned.numpy(), reward[:, None])
+            if done is not None:
+                np.copyto(self._done_pinned.numpy(), done, casting="unsafe")
+        return obs, reward, done
+
+    def _to_device(self, obs, reward=None, done=None):
+        # done comes back as a float32 tensor on self.device, like obs and reward
+        if not self._pinned:
+            obs = torch.from_numpy(obs.astype(np.uint8, copy=False)).to(self.device)
+            if reward is not None:
+                reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+            if done is not None:
+                done = torch.as_tensor(done, dtype=torch.float32, device=self.device)
+            return obs, reward, done
+        obs = self._obs_pinned.to(self.device, non_blocking=True)
+        if reward is not None:
+            reward = self._rew_pinned.to(self.device, non_blocking=True)
+        if done is not None:
+            done = self._done_pinned.to(self.device, non_blocking=True)
+        self._copied.record()
+        return obs, reward, done
+
+    def _step_and_stage(self):
+        # runs on the stepper thread: the observations land in the pinned DMA buffer
+        # before step_wait is even called
+        obs, reward, done, info = self.venv.step_wait()
+        obs, reward, done = self._stage(obs, reward, done)
+        return obs, reward, done, info
 
     def reset(self):
         obs = self.venv.reset()
-        obs = torch.from_numpy(obs).float().to(self.device)
+        obs, _, _ = self._to_device(*self._stage(obs))
         return obs
 
     def step_async(self, actions):
         actions = actions.cpu().numpy()
         self.venv.step_async(actions)
+        self._pending_step = self._stepper.submit(self._step_and_stage)
 
     def step_wait(self):
-        obs, reward, done, info = self.venv.step_wait()
-        obs = torch.from_numpy(obs).float().to(self.device)
-        reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+        obs, reward, done, info = self._pending_step.result()
+        self._pending_step = None
+        obs, reward, done = self._to_device(obs, reward, done)
         return obs, reward, done, info
 
 
@@ -244,34 +330,34 @@ class MicroRTSStatsRecorder(VecEnvWrapper):
     def __init__(self, env, gamma):
         super().__init__(env)
         self.gamma = gamma
+        self.raw_names = [str(rf) for rf in self.rfs]
 
     def reset(self):
         obs = self.venv.reset()
-        self.raw_rewards = [[] for _ in range(self.num_envs)]
+        # running per-env sum of each raw reward component over the current episode
+        self.raw_rewards = np.zeros(
+            (self.num_envs, len(self.raw_names)), dtype=np.float32
+        )
         return obs
 
     def step_wait(self):
         obs, rews, dones, infos = self.venv.step_wait()
-        for i in range(len(dones)):
-            self.raw_rewards[i] += [infos[i]["raw_rewards"]]
+        self.raw_rewards += np.stack([info["raw_rewards"] for info in infos])
         newinfos = list(infos[:])
-        for i in range(len(dones)):
-            if dones[i]:
-                info = infos[i].copy()
-                raw_rewards = np.array(self.raw_rewards[i]).sum(0)
-                raw_names = [str(rf) for rf in self.rfs]
-                info["microrts_stats"] = dict(zip(raw_names, raw_rewards))
-                self.raw_rewards[i] = []
-                newinfos[i] = info
+        for i in np.flatnonzero(dones):
+            info = infos[i].copy()
+            info["microrts_stats"] = dict(
+                zip(self.raw_names, self.raw_rewards[i].tolist())
+            )
+            self.raw_rewards[i] = 0
+            newinfos[i] = info
         return obs, rews, dones, newinfos
 
 
 # ALGO LOGIC: initialize agent here:
 class CategoricalMasked(Categorical):
     def __init__(self, *, logits, masks):
-        super().__init__(
-            logits=torch.where(masks, logits, torch.tensor(-1e8, device=logits.device))
-        )
+        super().__init__(logits=logits.masked_fill(~masks, -1e8))
 
     def entropy(self):
         # optional: masked entropy
@@ -316,11 +402,13 @@ class ResidualBlock(nn.Module):
 
     def forward(self, x):
         inputs = x
+        # the first relu must not touch `inputs`; the conv outputs are not needed by
+        # autograd, so the second relu and the residual add can reuse their buffers
         x = nn.functional.relu(x)
         x = self.conv0(x)
-        x = nn.functional.relu(x)
+        x = nn.functional.relu(x, inplace=True)
         x = self.conv1(x)
-        return x + inputs
+        return x.add_(inputs)
 
 
 class ConvSequence(nn.Module):
@@ -370,15 +458,28 @@ class Agent(nn.Module):
             nn.ReLU(),
         ]
         self.network = nn.Sequential(*convs)
-        self.actor = MicrortsUtils.layer_init(
-            nn.Linear(256, envs.action_space.nvec.sum()), 0.01
-        )
+        # the action-space layout is fixed; resolve it once instead of on every call
+        self._splits = tuple(envs.action_space.nvec.tolist())
+        self._nvec_sum = int(envs.action_space.nvec.sum())
+        # start/end of every head in the flat logits, so heads are sliced as plain views
+        self._offsets = np.cumsum((0,) + self._splits).tolist()
+        self.actor = MicrortsUtils.layer_init(nn.Linear(256, self._nvec_sum), 0.01)
         self.critic = MicrortsUtils.layer_init(nn.Linear(256, 1), 1.0)
+        # flat-logit index of every slot of a padded [num_heads, max(nvec)] head layout;
+        # padded slots point one past the end, at the column _pad_heads appends
+        nvec = list(self._splits)
+        self._num_heads = len(nvec)
+        pad_index = torch.full((len(nvec), max(nvec)), sum(nvec), dtype=torch.long)
+        for k, (start, n) in enumerate(zip(self._offsets, nvec)):
+            pad_index[k, :n] = torch.arange(start, start + n)
+        self.register_buffer("_pad_index", pad_index.view(-1), persistent=False)
+        # getUnitActionMasks runs here so the GPU can be fed while the JVM works
+        self._mask_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
     # ---------------------------------------------------------
     def forward(self, obs):
-        # obs [B,H,W,C] → [B,C,H,W]
-        return self.network(obs.permute(0, 3, 1, 2).to(self.device))
+        # obs [B,H,W,C] uint8 → [B,C,H,W] float
+        return self.network(obs.permute(0, 3, 1, 2).to(self.device).float())
 
     def get_value(self, obs):
         return self.critic(self.forward(obs))
@@ -387,81 +488,269 @@ class Agent(nn.Module):
     def _get_source_mask(self, batch):
         loc_np = np.asarray(self.envs.vec_client.getUnitLocationMasks(), dtype=np.bool_)
         loc_np = loc_np.reshape(batch, -1)
+        # checked on the host copy, so the sanity check never syncs the GPU
+        if not loc_np.any():
+            raise RuntimeError("source_mask all False! Invalid action mask!")
         return torch.as_tensor(loc_np, dtype=torch.bool, device=self.device)
 
     def _get_action_mask(self, chosen_units):
         mask_np = np.asarray(
             self.envs.vec_client.getUnitActionMasks(chosen_units), dtype=np.bool_
         )
+        if not mask_np.any():
+            raise RuntimeError("param_mask all False! Invalid action mask!")
         return torch.as_tensor(
             mask_np.reshape(len(chosen_units), -1), dtype=torch.bool, device=self.device
         )
 
+    def _request_action_mask(self, src_act):
+        # JPype releases the GIL during the Java call, so independent GPU work can be
+        # queued from this thread before waiting on the returned future
+        return self._mask_executor.submit(self._get_action_mask, src_act.cpu().numpy())
+
     # ---------------------------------------------------------
     def get_action(self, obs, action=None, invalid_action_masks=None):
-        B = obs.size(0)
-        feats = self.forward(obs)
-        logits = self.actor(feats)
-        splits = self.envs.action_space.nvec.tolist()
-        split_logits = torch.split(logits, splits, dim=1)
+        return self._get_action(self.forward(obs), action, invalid_action_masks)
+
+    def get_action_and_value(self, obs, action=None, invalid_action_masks=None):
+        # one backbone pass shared by the actor and the critic
+        return self._get_action(
+            self.forward(obs), action, invalid_action_masks, with_value=True
+        )
+
+    def _get_action(self, feats, action, invalid_action_masks, with_value=False):
+        B = feats.size(0)
+        # sampling and log-probs always run in fp32, even under autocast
+        logits = self.actor(feats).float()
 
         # -------- sample mode --------
         if action is None:
             source_mask = self._get_source_mask(B)
-            
-            if source_mask.sum().item() == 0:
-                raise RuntimeError("source_mask all False! Invalid action mask!")
-
-            src_cat = CategoricalMasked(logits=split_logits[0], masks=source_mask)
+            src_cat = CategoricalMasked(
+                logits=logits[:, : self._splits[0]], masks=source_mask
+            )
             src_act = src_cat.sample()
-
-            # parameter masks for each env
-            param_mask = self._get_action_mask(src_act.cpu().numpy())
-            if param_mask.sum().item() == 0:
-                raise RuntimeError("param_mask all False! Invalid action mask!")
-            
-            split_param_masks = torch.split(param_mask, splits[1:], dim=1)
-
-            acts = [src_act]
-            for lg, msk in zip(split_logits[1:], split_param_masks):
-                acts.append(CategoricalMasked(logits=lg, masks=msk).sample())
-            action = torch.stack(acts)
-            invalid_action_masks = torch.cat([source_mask, param_mask], dim=1)
+            pending_mask = self._request_action_mask(src_act)
+            if not with_value:
+                return self.complete_action(logits, source_mask, src_act, pending_mask)
+            # the critic runs on the GPU while the JVM computes the parameter masks
+            value = self.critic(feats).view(-1).float()
+            outputs = self.complete_action(logits, source_mask, src_act, pending_mask)
+            return outputs + (value,)
+        outputs = self._evaluate(logits, action, invalid_action_masks)
+        if with_value:
+            outputs += (self.critic(feats).view(-1).float(),)
+        return outputs
+
+    def complete_action(self, logits, source_mask, src_act, pending_mask=None):
+        # samples the parameter heads once the source units `src_act` are chosen;
+        # `pending_mask` is a future from _request_action_mask if it was already issued
+        # parameter masks for each env
+        if pending_mask is None:
+            pending_mask = self._request_action_mask(src_act)
+        param_mask = pending_mask.result()
+        invalid_action_masks = torch.cat([source_mask, param_mask], dim=1)
+        masked, masks = self._pad_heads(logits, invalid_action_masks)
+        log_probs = F.log_softmax(masked, dim=-1)
+
+        # every parameter head is drawn in one multinomial call over the padded rows;
+        # masked and padded slots have (near) zero probability, as with CategoricalMasked
+        B = logits.size(0)
+        param_probs = log_probs[:, 1:].exp().reshape(B * (self._num_heads - 1), -1)
+        param_act = torch.multinomial(param_probs, 1).view(B, -1)
+        action = torch.cat([src_act.unsqueeze(0), param_act.T], dim=0)
+        return self._score(log_probs, masks, action, invalid_action_masks)
+
+    def _evaluate(self, logits, action, invalid_action_masks):
         # -------- eval / update path --------
-        cats = [
-            CategoricalMasked(logits=lg, masks=msk.bool())
-            for lg, msk in zip(split_logits, invalid_action_masks.split(splits, 1))
-        ]
-        logprob = torch.stack([c.log_prob(a) for c, a in zip(cats, action)]).sum(0)
-        entropy = torch.stack([c.entropy() for c in cats]).sum(0)
+        masked, masks = self._pad_heads(logits, invalid_action_masks)
+        log_probs = F.log_softmax(masked, dim=-1)
+        return self._score(log_probs, masks, action, invalid_action_masks)
+
+    def _pad_heads(self, logits, masks):
+        # every head goes into one padded [B, num_heads, max(nvec)] block, so a single
+        # log_softmax and gather cover all of them; padded slots carry no probability
+        B = logits.size(0)
+        masked = logits.masked_fill(~masks, -1e8)
+        masked = torch.cat([masked, masked.new_full((B, 1), float("-inf"))], dim=1)
+        masked = masked.index_select(1, self._pad_index).view(B, self._num_heads, -1)
+        masks = torch.cat([masks, masks.new_zeros((B, 1))], dim=1)
+        masks = masks.index_select(1, self._pad_index).view(B, self._num_heads, -1)
+        return masked, masks
+
+    def _score(self, log_probs, masks, action, invalid_action_masks):
+        logprob = log_probs.gather(-1, action.T.unsqueeze(-1)).squeeze(-1)
+        # a fully masked head has log_prob 0 under CategoricalMasked (float32 rounding
+        # of -1e8), not -log(n); keep that so logprobs match the other scripts
+        logprob = logprob.masked_fill(~masks.any(-1), 0.0).sum(-1)
+        # invalid (and padded) slots add nothing to the entropy, as with CategoricalMasked
+        p_log_p = log_probs.exp() * log_probs.masked_fill(~masks, 0.0)
+        entropy = -p_log_p.sum(-1).sum(-1)
         return action, logprob, entropy, invalid_action_masks
 
 
+@torch.jit.script
+def compute_gae(
+    rewards,
+    values,
+    dones,
+    last_value,
+    next_done,
+    gamma: float,
+    gae_lambda: float,
+):
+    # reverse scan over the time axis, all envs at once; TorchScript runs the loop without
+    # the interpreter and fuses each step's elementwise ops
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    nextvalues = torch.cat([values[1:], last_value.view(1, -1)], dim=0)
+    deltas = rewards + gamma * nextvalues * nextnonterminals - values
+    advantages = torch.empty_like(rewards)
+    lastgaelam = torch.zeros_like(rewards[0])
+    for t in range(num_steps - 1, -1, -1):
+        lastgaelam = deltas[t] + gamma * gae_lambda * nextnonterminals[t] * lastgaelam
+        advantages[t] = lastgaelam
+    return advantages, advantages + values
+
+
+@torch.jit.script
+def compute_returns(rewards, values, dones, last_value, next_done, gamma: float):
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    returns = torch.empty_like(rewards)
+    next_return = last_value.view(-1)
+    for t in range(num_steps - 1, -1, -1):
+        next_return = rewards[t] + gamma * nextnonterminals[t] * next_return
+        returns[t] = next_return
+    return returns - values, returns
+
+
+class RolloutGraph:
+    # Captures the per-step rollout forward (backbone, critic, actor and the masked
+    # source-unit sample) into a CUDA graph once and replays it every env step. The
+    # parameter heads stay outside the graph: their masks come from the JVM and depend on
+    # the sampled source units. Weights are updated in place by the optimizer, so the graph
+    # always sees the current parameters.
+    def __init__(self, agent, example_obs, use_bf16=False, warmup_iters=3):
+        self.agent = agent
+        self.use_bf16 = use_bf16
+        self.source_width = agent._splits[0]
+        self.static_obs = torch.zeros_like(example_obs)
+        self.static_source_mask = torch.ones(
+            (example_obs.size(0), self.source_width), dtype=torch.bool, device=agent.device
+        )
+
+        # warm up on a side stream before capturing, as required by torch.cuda.graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(warmup_iters):
+                self._forward()
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.static_value, self.static_logits, self.static_src_act = self._forward()
+
+    def _forward(self):
+        # the autocast weight-cast cache must not outlive a replay
+        with bf16_autocast(self.use_bf16, cache_enabled=False):
+            feats = self.agent.forward(self.static_obs)
+            logits = self.agent.actor(feats).float()
+            value = self.agent.critic(feats).view(-1).float()
+        # Categorical validates its arguments with host syncs, which cannot be captured
+        src_logits = logits[:, : self.source_width].masked_fill(
+            ~self.static_source_mask, -1e8
+        )
+        src_act = torch.multinomial(F.softmax(src_logits, dim=-1), 1).squeeze(-1)
+        return value, logits, src_act
+
+    def __call__(self, obs):
+        source_mask = self.agent._get_source_mask(obs.size(0))
+        self.static_obs.copy_(obs)
+        self.static_source_mask.copy_(source_mask)
+        self.graph.replay()
+        action, logproba, _, invalid_action_masks = self.agent.complete_action(
+            self.static_logits, source_mask, self.static_src_act
+        )
+        return self.static_value.clone(), action, logproba, invalid_action_masks
+
+
+def bf16_autocast(enabled, cache_enabled=True):
+    if enabled:
+        return torch.autocast(
+            device_type="cuda", dtype=torch.bfloat16, cache_enabled=cache_enabled
+        )
+    return contextlib.nullcontext()
+
+
 def main():
     # 初始化環境與參數
     args, device, envs, writer, experiment_name, run, CHECKPOINT_FREQUENCY = (
         set_environment()
     )
     agent = Agent(envs, device).to(device)
-    optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    # bf16 needs no GradScaler, but only exists with torch.autocast on Ampere or newer
+    use_bf16 = (
+        args.bf16
+        and device.type == "cuda"
+        and hasattr(torch, "autocast")
+        and torch.cuda.is_bf16_supported()
+    )
+    # torch.cuda.graph needs torch >= 1.10
+    use_cuda_graph = (
+        args.cuda_graph and device.type == "cuda" and hasattr(torch.cuda, "graph")
+    )
+    if args.compile:
+        # nn.Module.compile works in place, so state_dict keys (checkpoints, target_agent)
+        # are unchanged. The rollout (num_envs) and update (minibatch_size) batch sizes each
+        # get their own static specialization. Inductor's own CUDA graphs cannot be nested
+        # in the RolloutGraph capture, so "reduce-overhead" is only used without it.
+        mode = "default" if use_cuda_graph else "reduce-overhead"
+        for module in (agent.network, agent.actor, agent.critic):
+            module.compile(mode=mode, dynamic=False, fullgraph=True)
+    # fused Adam (one kernel for every parameter) needs cuda params and torch >= 1.13
+    fused_adam = (
+        device.type == "cuda" and "fused" in inspect.signature(optim.Adam).parameters
+    )
+    optimizer = optim.Adam(
+        agent.parameters(),
+        lr=args.learning_rate,
+        eps=1e-5,
+        **({"fused": True} if fused_adam else {}),
+    )
     if args.anneal_lr:
         # https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/ppo2/defaults.py#L20
         lr = lambda f: f * args.learning_rate
 
+    obs_shape = envs.observation_space.shape
+    action_shape = envs.action_space.shape
+
     # ALGO Logic: Storage for epoch data
     obs = torch.zeros(
-        (args.num_steps, args.num_envs) + envs.observation_space.shape
-    ).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + envs.action_space.shape).to(
-        device
+        (args.num_steps, args.num_envs) + obs_shape,
+        dtype=torch.uint8,
+        device=device,
     )
+    actions = torch.zeros((args.num_steps, args.num_envs) + action_shape).to(device)
     logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
     rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
     dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
     values = torch.zeros((args.num_steps, args.num_envs)).to(device)
     invalid_action_masks = torch.zeros(
-        (args.num_steps, args.num_envs) + (envs.action_space.nvec.sum(),)
-    ).to(device)
+        (args.num_steps, args.num_envs) + (agent._nvec_sum,),
+        dtype=torch.bool,
+        device=device,
+    )
+    # flattened views of the storage; they share memory with the buffers the rollout
+    # writes into, so they are built once instead of once per update
+    b_obs = obs.view((-1,) + obs_shape)
+    b_logprobs = logprobs.view(-1)
+    b_actions = actions.view((-1,) + action_shape)
+    b_values = values.view(-1)
+    b_invalid_action_masks = invalid_action_masks.view(
+        (-1, invalid_action_masks.shape[-1])
+    )
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
@@ -485,6 +774,15 @@ def main():
         agent.eval()
         print(f"resumed at update {starting_update}")
 
+    # only kle_rollback needs a copy of the pre-epoch weights; build it once, if at all
+    target_agent = None
+    if args.kle_rollback:
+        target_agent = Agent(envs, device).to(device)
+
+    rollout_graph = None
+    if use_cuda_graph:
+        rollout_graph = RolloutGraph(agent, next_obs, use_bf16)
+
     early_stop_K = 10  # 看過去多少次 update
     early_stop_max_var = 0.05  # 最小進步幅度
     recent_rewards = []  # 存每個update的平均reward
@@ -505,17 +803,27 @@ def main():
             dones[step] = next_done
             # ALGO LOGIC: put action logic here
             with torch.no_grad():
-                values[step] = agent.get_value(obs[step]).flatten()
-                action, logproba, _, invalid_action_masks[step] = agent.get_action(
-                    obs[step]
-                )
+                if rollout_graph is not None:
+                    values[step], action, logproba, invalid_action_masks[step] = (
+                        rollout_graph(obs[step])
+                    )
+                else:
+                    with bf16_autocast(use_bf16):
+                        (
+                            action,
+                            logproba,
+                            _,
+                            invalid_action_masks[step],
+                            values[step],
+                        ) = agent.get_action_and_value(obs[step])
 
+            # TRY NOT TO MODIFY: execute the game and log data.
+            # the env steps in the background while this step's outputs are stored
+            envs.step_async(action.T)
             actions[step] = action.T
             logprobs[step] = logproba
-
-            # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, rs, ds, infos = envs.step(action.T)
-            rewards[step], next_done = rs.view(-1), torch.Tensor(ds).to(device)
+            next_obs, rs, ds, infos = envs.step_wait()
+            rewards[step], next_done = rs.view(-1), ds
 
             for info in infos:
                 if "episode" in info.keys():
@@ -535,73 +843,48 @@ def main():
 
         # bootstrap reward if not done. reached the batch limit
         with torch.no_grad():
-            last_value = agent.get_value(next_obs.to(device)).reshape(1, -1)
+            # same precision as the rollout values it is combined with in the GAE
+            with bf16_autocast(use_bf16):
+                last_value = agent.get_value(next_obs.to(device)).float().reshape(1, -1)
             if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        nextvalues = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        nextvalues = values[t + 1]
-                    delta = (
-                        rewards[t]
-                        + args.gamma * nextvalues * nextnonterminal
-                        - values[t]
-                    )
-                    advantages[t] = lastgaelam = (
-                        delta
-                        + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                    )
-                returns = advantages + values
+                advantages, returns = compute_gae(
+                    rewards,
+                    values,
+                    dones,
+                    last_value,
+                    next_done,
+                    args.gamma,
+                    args.gae_lambda,
+                )
             else:
-                returns = torch.zeros_like(rewards).to(device)
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        next_return = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        next_return = returns[t + 1]
-                    returns[t] = rewards[t] + args.gamma * nextnonterminal * next_return
-                advantages = returns - values
-
-        # flatten the batch
-        b_obs = obs.reshape((-1,) + envs.observation_space.shape)
-        b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + envs.action_space.shape)
-        b_advantages = advantages.reshape(-1)
-        b_returns = returns.reshape(-1)
-        b_values = values.reshape(-1)
-        b_invalid_action_masks = invalid_action_masks.reshape(
-            (-1, invalid_action_masks.shape[-1])
-        )
+                advantages, returns = compute_returns(
+                    rewards, values, dones, last_value, next_done, args.gamma
+                )
 
-        # Optimizaing the policy and value network
-        target_agent = Agent(envs, device).to(device)
+        # flatten the batch (advantages/returns are fresh tensors every update)
+        b_advantages = advantages.view(-1)
+        b_returns = returns.view(-1)
 
-        inds = np.arange(
-            args.batch_size,
-        )
+        # Optimizaing the policy and value network
         for i_epoch_pi in range(args.update_epochs):
-            np.random.shuffle(inds)
-            target_agent.load_state_dict(agent.state_dict())
+            # shuffled on the device, so minibatch indexing never uploads host indices
+            inds = torch.randperm(args.batch_size, device=device)
+            if args.kle_rollback:
+                target_agent.load_state_dict(agent.state_dict())
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 minibatch_ind = inds[start:end]
                 mb_advantages = b_advantages[minibatch_ind]
                 if args.norm_adv:
-                    mb_advantages = (mb_advantages - mb_advantages.mean()) / (
-                        mb_advantages.std() + 1e-8
-                    )
+                    adv_std, adv_mean = torch.std_mean(mb_advantages)
+                    mb_advantages = (mb_advantages - adv_mean).div_(adv_std + 1e-8)
 
-                _, newlogproba, entropy, _ = agent.get_action(
-                    b_obs[minibatch_ind],
-                    b_actions.long()[minibatch_ind].T,
-                    b_invalid_action_masks[minibatch_ind],
-                )
+                with bf16_autocast(use_bf16):
+                    _, newlogproba, entropy, _, new_values = agent.get_action_and_value(
+                        b_obs[minibatch_ind],
+                        b_actions[minibatch_ind].long().T,
+                        b_invalid_action_masks[minibatch_ind],
+                    )
                 ratio = (newlogproba - b_logprobs[minibatch_ind]).exp()
 
                 # Stats
@@ -616,7 +899,6 @@ def main():
                 entropy_loss = entropy.mean()
 
                 # Value loss
-                new_values = agent.get_value(b_obs[minibatch_ind]).view(-1)
                 if args.clip_vloss:
                     v_loss_unclipped = (new_values - b_returns[minibatch_ind]) ** 2
                     v_clipped = b_values[minibatch_ind] + torch.clamp(
@@ -628,11 +910,11 @@ def main():
                     v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
                     v_loss = 0.5 * v_loss_max.mean()
                 else:
-                    v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2)
+                    v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2).mean()
 
                 loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
 
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 loss.backward()
                 nn.utils.clip_grad_norm_(agent.parameters(), args.max_grad_norm)
                 optimizer.step()
@@ -645,22 +927,22 @@ def main():
                     b_logprobs[minibatch_ind]
                     - agent.get_action(
                         b_obs[minibatch_ind],
-                        b_actions.long()[minibatch_ind].T,
+                        b_actions[minibatch_ind].long().T,
                         b_invalid_action_masks[minibatch_ind],
-                        envs,
                     )[1]
                 ).mean() > args.target_kl:
                     agent.load_state_dict(target_agent.state_dict())
                     break
 
         # early stop 判斷
-        avg_reward = float(rewards.mean().cpu().item())
-        recent_rewards.append(avg_reward)
+        # kept on the device; only read back once the window is full
+        recent_rewards.append(rewards.mean())
         if len(recent_rewards) > early_stop_K:
             recent_rewards.pop(0)  # 保持長度 = K
         if len(recent_rewards) == early_stop_K:
-            mean_r = np.mean(recent_rewards)
-            std_r = np.std(recent_rewards)
+            window = torch.stack(recent_rewards).cpu().numpy()
+            mean_r = np.mean(window)
+            std_r = np.std(window)
             if std_r / (mean_r + 1e-8) < early_stop_max_var:
                 print(f"Early stopping triggered at update {update}!")
                 if args.prod_mode:
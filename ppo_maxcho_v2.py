@@ -8,6 +8,8 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.profiler
 
 import argparse
+import concurrent.futures
+import json
 from distutils.util import strtobool
 import numpy as np
 import gym
@@ -24,69 +26,125 @@ from stable_baselines3.common.vec_env import VecEnvWrapper, VecVideoRecorder
 from stable_baselines3.common.vec_env import VecFrameStack
 
 
-# --------------------------- Wrapper: Boundary ---------------------------
-class BoundaryWrapper(VecEnvWrapper):
-    def __init__(self, venv: VecEnvWrapper):
-        super().__init__(venv)
-        self.boundary_map = None
-
-    def reset(self):
-        obs = self.venv.reset()  # shape: (batch, h, w, nf)
-        return self._add_boundary(obs)
-
-    def step_wait(self):
-        obs, rews, dones, infos = self.venv.step_wait()
-        return self._add_boundary(obs), rews, dones, infos
-
-    def _add_boundary(self, obs: np.ndarray) -> np.ndarray:
-        batch_size, h, w, _ = obs.shape
-        if self.boundary_map is None or self.boundary_map.shape != (h, w):
-            bm = np.zeros((h, w), dtype=np.float32)
-            bm[0, :] = 1
-            bm[-1, :] = 1
-            bm[:, 0] = 1
-            bm[:, -1] = 1
-            self.boundary_map = bm
-        b_map = np.tile(self.boundary_map[None, :, :, None], (batch_size, 1, 1, 1))
-        return np.concatenate([obs, b_map], axis=-1)
-
-
-# --------------------------- Wrapper: Attack Power One-hot Binning ---------------------------
-class AttackPowerOneHotWrapper(VecEnvWrapper):
-    def __init__(self, venv: VecEnvWrapper, json_path: str, damage_bins: list):
-        super().__init__(venv)
+# --------------------------- Wrapper: Boundary + Attack Power One-hot ---------------------------
+# appends the boundary plane and the attack-power one-hot bins to the raw obs and moves
+# the result to `device`; every channel group is written into the same host buffer
+class FusedObsWrapper(VecEnvWrapper):
+    def __init__(self, venv, device, json_path: str, damage_bins: list):
+        h, w, c = venv.observation_space.shape
+        self.num_bins = len(damage_bins)
+        observation_space = Box(
+            low=0.0, high=1.0, shape=(h, w, c + 1 + self.num_bins), dtype=np.float32
+        )
+        super().__init__(venv, observation_space=observation_space)
+        self.device = device
         with open(json_path, "r") as f:
             unit_table = json.load(f)["unitTypes"]
         self.id_to_damage = {u["ID"]: u["maxDamage"] for u in unit_table}
+        self.dmg_lut = np.zeros(max(self.id_to_damage) + 1, dtype=np.int32)
+        for utype, damage in self.id_to_damage.items():
+            self.dmg_lut[utype] = damage
         self.damage_bins = damage_bins
-        self.num_bins = len(damage_bins)
+        self.bins = np.asarray(damage_bins)
+        # searchsorted only equals the original "first bin with damage <= threshold"
+        # scan when the thresholds are ascending
+        assert np.all(np.diff(self.bins) >= 0), "damage_bins must be sorted ascending"
+        # on cuda the host buffers are pinned so the copy to the device is an async DMA.
+        # Two of them are used alternately, so filling the next observation never waits on
+        # the copy out of the previous one
+        self._pinned = torch.cuda.is_available() and torch.device(device).type == "cuda"
+        self._host = None
+        self._i = 0
+        if self._pinned:
+            self._rew_host = [
+                torch.empty((self.num_envs, 1), dtype=torch.float32).pin_memory()
+                for _ in range(2)
+            ]
+            self._copied = [torch.cuda.Event(), torch.cuda.Event()]
+        # MicroRTSVecEnv already steps every env in one batched JNI call, so instead of a
+        # subprocess pool the step (and the host half of the obs processing) runs on a
+        # worker thread between step_async and step_wait; JPype releases the GIL
+        self._stepper = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending_step = None
 
     def reset(self):
-        obs = self.venv.reset()
-        return self._add_attack_onehot(obs)
+        obs = self.venv.reset()  # shape: (batch, h, w, nf)
+        obs, _ = self._to_device(*self._stage(obs))
+        return obs
+
+    def step_async(self, actions):
+        actions = actions.cpu().numpy()
+        self.venv.step_async(actions)
+        self._pending_step = self._stepper.submit(self._step_and_stage)
 
     def step_wait(self):
-        obs, rews, dones, infos = self.venv.step_wait()
-        return self._add_attack_onehot(obs), rews, dones, infos
+        i, reward, done, info = self._pending_step.result()
+        self._pending_step = None
+        obs, reward = self._to_device(i, reward)
+        return obs, reward, done, info
 
-    def _add_attack_onehot(self, obs: np.ndarray) -> np.ndarray:
-        batch_size, h, w, _ = obs.shape
+    def _step_and_stage(self):
+        # runs on the stepper thread
+        obs, reward, done, info = self.venv.step_wait()
+        i, reward = self._stage(obs, reward)
+        return i, reward, done, info
+
+    def _alloc_host(self, shape, c):
+        host = torch.empty(shape, dtype=torch.float32, pin_memory=self._pinned)
+        # the boundary plane is constant, so it is written only once
+        bm = host.numpy()[..., c]
+        bm[...] = 0
+        bm[:, 0, :] = 1
+        bm[:, -1, :] = 1
+        bm[:, :, 0] = 1
+        bm[:, :, -1] = 1
+        return host
+
+    def _stage(self, obs: np.ndarray, reward: np.ndarray = None):
+        # host half: fill the next host buffer, returning its index
+        batch_size, h, w, c = obs.shape
+        if self._host is None:
+            shape = (batch_size, h, w, c + 1 + self.num_bins)
+            self._host = [self._alloc_host(shape, c) for _ in range(2)]
+        i = self._i
+        self._i ^= 1
+        if self._pinned:
+            # the buffer may only be refilled once the copy out of it (two steps ago) is done
+            self._copied[i].synchronize()
+        host_np = self._host[i].numpy()
+        np.copyto(host_np[..., :c], obs)
+        self._add_attack_onehot(host_np[..., c + 1 :])
+        if self._pinned and reward is not None:
+            np.copyto(self._rew_host[i].numpy(), reward[:, None])
+        return i, reward
+
+    def _to_device(self, i: int, reward: np.ndarray = None):
+        host = self._host[i]
+        if not self._pinned:
+            obs = host.to(self.device, copy=True)
+            if reward is not None:
+                reward = torch.from_numpy(reward).unsqueeze(dim=1).float()
+            return obs, reward
+        obs = host.to(self.device, non_blocking=True)
+        if reward is not None:
+            reward = self._rew_host[i].to(self.device, non_blocking=True)
+        self._copied[i].record()
+        return obs, reward
+
+    def _add_attack_onehot(self, onehot_map: np.ndarray):
+        batch_size, h, w, _ = onehot_map.shape
         unit_type_map = np.asarray(self.venv.vec_client.getUnitType(), dtype=np.int32)
-        onehot_map = np.zeros((batch_size, h, w, self.num_bins), dtype=np.float32)
-        for b in range(batch_size):
-            for i in range(h):
-                for j in range(w):
-                    utype = int(unit_type_map[b, i, j])
-                    if utype < 0:
-                        continue
-                    damage = self.id_to_damage.get(utype, 0)
-                    bin_idx = 0
-                    for k, thresh in enumerate(self.damage_bins):
-                        if damage <= thresh:
-                            bin_idx = k
-                            break
-                    onehot_map[b, i, j, bin_idx] = 1.0
-        return np.concatenate([obs, onehot_map], axis=-1)
+        unit_type_map = unit_type_map.reshape(batch_size, h, w)
+        utm = unit_type_map.clip(0, len(self.dmg_lut) - 1)
+        # IDs past the table have no entry, i.e. damage 0 as with id_to_damage.get
+        damage = np.where(unit_type_map < len(self.dmg_lut), self.dmg_lut[utm], 0)
+        bin_idx = np.searchsorted(self.bins, damage, side="left")
+        # damage above the last threshold falls back to bin 0, as the original scan did
+        # when no threshold matched
+        bin_idx[bin_idx == self.num_bins] = 0
+        onehot_map[...] = 0
+        np.put_along_axis(onehot_map, bin_idx[..., None], 1.0, axis=-1)
+        onehot_map[unit_type_map < 0] = 0.0
 
 
 # --------------------------- Main Environment Setup with Extras ---------------------------
@@ -181,6 +239,14 @@ def set_environment():
         "--map-path", type=str, default="maps/16x16/basesWorkers16x16.xml"
     )
     parser.add_argument("--n-stack", type=int, default=4)
+    parser.add_argument(
+        "--compile-model",
+        type=lambda x: bool(strtobool(x)),
+        default=True,
+        nargs="?",
+        const=True,
+        help="on cuda, compile the backbone and heads with torch.compile (torch >= 2.2)",
+    )
 
     args = parser.parse_args()
     if not args.seed:
@@ -208,14 +274,10 @@ def set_environment():
         reward_weight=np.array([10.0, 1.0, 1.0, 0.2, 1.0, 4.0]),
     )
     envs = VecMonitor(envs)
-    # Add Boundary channels
-    envs = BoundaryWrapper(envs)
-    # Add Attack Power One-hot bins
+    # Add Boundary channel and Attack Power One-hot bins, as PyTorch tensors
     damage_bins = [0, 1, 2, 4, 999]
     json_path = os.path.join(os.path.dirname(__file__), "TestUnitTypeTable.json")
-    envs = AttackPowerOneHotWrapper(envs, json_path, damage_bins)
-    # Convert to PyTorch tensors
-    envs = VecPyTorch(envs, device)
+    envs = FusedObsWrapper(envs, device, json_path, damage_bins)
     # Stack last n frames
     envs = VecFrameStack(envs, n_stack=args.n_stack)
     # Video recorder optional
@@ -230,7 +292,9 @@ def set_environment():
             video_length=2000,
         )
     experiment_name = f"{args.gym_id}__{args.exp_name}__{args.seed}__{int(time.time())}"
-    writer = SummaryWriter(f"runs/{experiment_name}")
+    # events are queued and written by a background thread; a deep queue keeps the
+    # per-update scalars from forcing a flush to disk every few calls
+    writer = SummaryWriter(f"runs/{experiment_name}", max_queue=1000)
     writer.add_text(
         "hyperparameters",
         "|param|value|\n|-|-|\n%s"
@@ -249,7 +313,10 @@ def set_environment():
             save_code=True,
         )
         wandb.tensorboard.patch(save=False)
-        writer = SummaryWriter(f"/tmp/{args.exp_name}_{int(time.time())}")
+        writer = SummaryWriter(
+            f"/tmp/{args.exp_name}_{int(time.time())}", max_queue=1000
+        )
+        os.makedirs(f"models/{experiment_name}", exist_ok=True)
 
     return args, device, envs, writer, experiment_name, run, CHECKPOINT_FREQUENCY
 
@@ -277,44 +344,19 @@ class VecMonitor(VecEnvWrapper):
         self.eprets += rews
         self.eplens += 1
 
+        done_idx = np.flatnonzero(dones)
+        if done_idx.size == 0:
+            return obs, rews, dones, infos
         newinfos = list(infos[:])
-        for i in range(len(dones)):
-            if dones[i]:
-                info = infos[i].copy()
-                ret = self.eprets[i]
-                eplen = self.eplens[i]
-                epinfo = {
-                    "r": ret,
-                    "l": eplen,
-                    "t": round(time.time() - self.tstart, 6),
-                }
-                info["episode"] = epinfo
-                self.epcount += 1
-                self.eprets[i] = 0
-                self.eplens[i] = 0
-                newinfos[i] = info
-        return obs, rews, newinfos, dones
-
-
-class VecPyTorch(VecEnvWrapper):
-    def __init__(self, venv, device):
-        super(VecPyTorch, self).__init__(venv)
-        self.device = device
-
-    def reset(self):
-        obs = self.venv.reset()
-        obs = torch.from_numpy(obs).float().to(self.device)
-        return obs
-
-    def step_async(self, actions):
-        actions = actions.cpu().numpy()
-        self.venv.step_async(actions)
-
-    def step_wait(self):
-        obs, reward, done, info = self.venv.step_wait()
-        obs = torch.from_numpy(obs).float().to(self.device)
-        reward = torch.from_numpy(reward).unsqueeze(dim=1).float().to(self.device)
-        return obs, reward, done, info
+        t = round(time.time() - self.tstart, 6)
+        for i in done_idx:
+            info = infos[i].copy()
+            info["episode"] = {"r": self.eprets[i], "l": self.eplens[i], "t": t}
+            newinfos[i] = info
+        self.epcount += done_idx.size
+        self.eprets[done_idx] = 0
+        self.eplens[done_idx] = 0
+        return obs, rews, dones, newinfos
 
 
 class MicroRTSStatsRecorder(VecEnvWrapper):
@@ -348,9 +390,7 @@ class MicroRTSStatsRecorder(VecEnvWrapper):
 # ALGO LOGIC: initialize agent here:
 class CategoricalMasked(Categorical):
     def __init__(self, *, logits, masks):
-        super().__init__(
-            logits=torch.where(masks, logits, torch.tensor(-1e8, device=logits.device))
-        )
+        super().__init__(logits=logits.masked_fill(~masks, -1e8))
 
     def entropy(self):
         return super().entropy()
@@ -443,20 +483,36 @@ class Agent(nn.Module):
             convs.append(seq)
         convs += [
             nn.Flatten(),
-            nn.ReLU(),
             nn.Linear(shape[0] * shape[1] * shape[2], 256),
             nn.ReLU(),
         ]
-        self.network = nn.Sequential(*convs)
-        self.actor = MicrortsUtils.layer_init(
-            nn.Linear(256, envs.action_space.nvec.sum()), 0.01
-        )
+        # obs arrive as [B,H,W,C], which is exactly the channels_last layout of [B,C,H,W],
+        # so with a channels_last network cudnn consumes them without a transpose copy
+        self.network = nn.Sequential(*convs).to(memory_format=torch.channels_last)
+        # the action-space layout is fixed; resolve it once instead of on every call
+        self._splits = envs.action_space.nvec.tolist()
+        self._nvec_sum = int(envs.action_space.nvec.sum())
+        self.actor = MicrortsUtils.layer_init(nn.Linear(256, self._nvec_sum), 0.01)
         self.critic = MicrortsUtils.layer_init(nn.Linear(256, 1), 1.0)
+        # flat-logit index of every slot of a padded [num_heads, max(nvec)] head layout;
+        # padded slots point one past the end, at the column _pad_heads appends
+        nvec = self._splits
+        self._num_heads = len(nvec)
+        offsets = np.cumsum([0] + nvec[:-1]).tolist()
+        pad_index = torch.full((len(nvec), max(nvec)), sum(nvec), dtype=torch.long)
+        for k, (start, n) in enumerate(zip(offsets, nvec)):
+            pad_index[k, :n] = torch.arange(start, start + n)
+        self.register_buffer("_pad_index", pad_index.view(-1), persistent=False)
+        # reusable host buffers for the JNI masks (pinned on cuda, so the upload is an
+        # async copy), each with an event guarding it against a refill mid-copy
+        self._pinned = torch.cuda.is_available() and torch.device(device).type == "cuda"
+        self._mask_host = {}
 
     # ---------------------------------------------------------
     def forward(self, obs):
-        # obs [B,H,W,C] → [B,C,H,W]
-        return self.network(obs.permute(0, 3, 1, 2).to(self.device))
+        # obs [B,H,W,C] uint8 → [B,C,H,W] float (channels_last memory)
+        x = obs.to(self.device, non_blocking=True).permute(0, 3, 1, 2).float()
+        return self.network(x.contiguous(memory_format=torch.channels_last))
 
     def get_value(self, obs):
         return self.critic(self.forward(obs))
@@ -465,56 +521,130 @@ class Agent(nn.Module):
     def _get_source_mask(self, batch):
         loc_np = np.asarray(self.envs.vec_client.getUnitLocationMasks(), dtype=np.bool_)
         loc_np = loc_np.reshape(batch, -1)
-        return torch.as_tensor(loc_np, dtype=torch.bool, device=self.device)
+        # checked on the host: a .item() on the device tensor would sync the stream
+        if not loc_np.any():
+            raise RuntimeError("source_mask all False! Invalid action mask!")
+        return self._upload_mask("source", loc_np)
 
     def _get_action_mask(self, chosen_units):
         mask_np = np.asarray(
             self.envs.vec_client.getUnitActionMasks(chosen_units), dtype=np.bool_
         )
-        return torch.as_tensor(
-            mask_np.reshape(len(chosen_units), -1), dtype=torch.bool, device=self.device
-        )
+        if not mask_np.any():
+            raise RuntimeError("param_mask all False! Invalid action mask!")
+        return self._upload_mask("action", mask_np.reshape(len(chosen_units), -1))
+
+    def _upload_mask(self, key, mask_np):
+        entry = self._mask_host.get(key)
+        if entry is None or entry[0].shape != mask_np.shape:
+            host = torch.empty(mask_np.shape, dtype=torch.bool, pin_memory=self._pinned)
+            entry = (host, torch.cuda.Event() if self._pinned else None)
+            self._mask_host[key] = entry
+        host, copied = entry
+        if copied is not None:
+            copied.synchronize()
+        np.copyto(host.numpy(), mask_np)
+        if copied is None:
+            return host.to(self.device, copy=True)
+        mask = host.to(self.device, non_blocking=True)
+        copied.record()
+        return mask
 
     # ---------------------------------------------------------
     def get_action(self, obs, action=None, invalid_action_masks=None):
-        B = obs.size(0)
+        logits = self.actor(self.forward(obs))
+        return self._get_action(logits, action, invalid_action_masks)
+
+    def get_action_and_value(self, obs, action=None, invalid_action_masks=None):
+        # one backbone pass shared by the actor and critic heads
         feats = self.forward(obs)
-        logits = self.actor(feats)
-        splits = self.envs.action_space.nvec.tolist()
-        split_logits = torch.split(logits, splits, dim=1)
+        value = self.critic(feats).view(-1)
+        action, logprob, entropy, invalid_action_masks = self._get_action(
+            self.actor(feats), action, invalid_action_masks
+        )
+        return value, action, logprob, entropy, invalid_action_masks
+
+    def _get_action(self, logits, action=None, invalid_action_masks=None):
+        B = logits.size(0)
 
         # -------- sample mode --------
         if action is None:
             source_mask = self._get_source_mask(B)
 
-            if source_mask.sum().item() == 0:
-                raise RuntimeError("source_mask all False! Invalid action mask!")
-
-            src_cat = CategoricalMasked(logits=split_logits[0], masks=source_mask)
+            src_cat = CategoricalMasked(
+                logits=logits[:, : self._splits[0]], masks=source_mask
+            )
             src_act = src_cat.sample()
 
             # parameter masks for each env
             param_mask = self._get_action_mask(src_act.cpu().numpy())
-            if param_mask.sum().item() == 0:
-                raise RuntimeError("param_mask all False! Invalid action mask!")
-
-            split_param_masks = torch.split(param_mask, splits[1:], dim=1)
-
-            acts = [src_act]
-            for lg, msk in zip(split_logits[1:], split_param_masks):
-                acts.append(CategoricalMasked(logits=lg, masks=msk).sample())
-            action = torch.stack(acts)
             invalid_action_masks = torch.cat([source_mask, param_mask], dim=1)
 
+            # every parameter head is sampled from one batched categorical
+            masked, masks = self._pad_heads(logits, invalid_action_masks)
+            param_act = Categorical(logits=masked[:, 1:]).sample()
+            action = torch.cat([src_act.unsqueeze(0), param_act.T], dim=0)
+        else:
+            masked, masks = self._pad_heads(logits, invalid_action_masks)
+
         # -------- eval / update path --------
-        cats = [
-            CategoricalMasked(logits=lg, masks=msk.bool())
-            for lg, msk in zip(split_logits, invalid_action_masks.split(splits, 1))
-        ]
-        logprob = torch.stack([c.log_prob(a) for c, a in zip(cats, action)]).sum(0)
-        entropy = torch.stack([c.entropy() for c in cats]).sum(0)
+        log_probs = F.log_softmax(masked, dim=-1)
+        logprob = log_probs.gather(-1, action.T.unsqueeze(-1)).squeeze(-1)
+        # a fully masked head has log_prob 0 under CategoricalMasked (float32 rounding
+        # of -1e8), not -log(n); keep that so stored logprobs are unchanged
+        logprob = logprob.masked_fill(~masks.any(-1), 0.0).sum(-1)
+        # invalid (and padded) slots add nothing to the entropy, as with CategoricalMasked
+        p_log_p = log_probs.exp() * log_probs.masked_fill(~masks, 0.0)
+        entropy = -p_log_p.sum(-1).sum(-1)
         return action, logprob, entropy, invalid_action_masks
 
+    def _pad_heads(self, logits, masks):
+        # every head goes into one padded [B, num_heads, max(nvec)] block, so a single
+        # log_softmax covers all of them; padded slots carry no probability
+        B = logits.size(0)
+        masked = logits.masked_fill(~masks, -1e8)
+        masked = torch.cat([masked, masked.new_full((B, 1), float("-inf"))], dim=1)
+        masked = masked.index_select(1, self._pad_index).view(B, self._num_heads, -1)
+        masks = torch.cat([masks, masks.new_zeros((B, 1))], dim=1)
+        masks = masks.index_select(1, self._pad_index).view(B, self._num_heads, -1)
+        return masked, masks
+
+
+@torch.jit.script
+def compute_gae(
+    rewards,
+    values,
+    dones,
+    last_value,
+    next_done,
+    gamma: float,
+    gae_lambda: float,
+):
+    # reverse scan over the time axis, all envs at once; TorchScript runs the loop without
+    # the interpreter and fuses each step's elementwise ops
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    nextvalues = torch.cat([values[1:], last_value.view(1, -1)], dim=0)
+    deltas = rewards + gamma * nextvalues * nextnonterminals - values
+    advantages = torch.empty_like(rewards)
+    lastgaelam = torch.zeros_like(rewards[0])
+    for t in range(num_steps - 1, -1, -1):
+        lastgaelam = deltas[t] + gamma * gae_lambda * nextnonterminals[t] * lastgaelam
+        advantages[t] = lastgaelam
+    return advantages, advantages + values
+
+
+@torch.jit.script
+def compute_returns(rewards, values, dones, last_value, next_done, gamma: float):
+    num_steps = rewards.size(0)
+    nextnonterminals = 1.0 - torch.cat([dones[1:], next_done.view(1, -1)], dim=0)
+    returns = torch.empty_like(rewards)
+    next_return = last_value.view(-1)
+    for t in range(num_steps - 1, -1, -1):
+        next_return = rewards[t] + gamma * nextnonterminals[t] * next_return
+        returns[t] = next_return
+    return returns - values, returns
+
 
 def main():
     # 初始化環境與參數
@@ -522,25 +652,48 @@ def main():
         set_environment()
     )
     agent = Agent(envs, device).to(device)
-    target_agent = Agent(envs, device).to(device)  # <--- 建立一次 target_agent
+    if args.compile_model and device.type == "cuda" and hasattr(nn.Module, "compile"):
+        # nn.Module.compile works in place (after .to(device)), so state_dict keys for
+        # checkpoints and target_agent are unchanged
+        for module in (agent.network, agent.actor, agent.critic):
+            module.compile(mode="reduce-overhead", fullgraph=False)
+    # only kle_rollback restores from target_agent, so it is not built otherwise
+    target_agent = Agent(envs, device).to(device) if args.kle_rollback else None
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
     if args.anneal_lr:
         lr = lambda f: f * args.learning_rate
 
     # ALGO Logic: Storage for epoch data
+    # every obs channel (raw features, boundary, damage bins) is a 0/1 plane, so the
+    # rollout keeps them as uint8 and the Agent casts to float on the device
     obs = torch.zeros(
-        (args.num_steps, args.num_envs) + envs.observation_space.shape
-    ).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + envs.action_space.shape).to(
-        device
+        (args.num_steps, args.num_envs) + envs.observation_space.shape,
+        dtype=torch.uint8,
+        device=device,
+    )
+    actions = torch.zeros(
+        (args.num_steps, args.num_envs) + envs.action_space.shape, device=device
     )
-    logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
-    values = torch.zeros((args.num_steps, args.num_envs)).to(device)
+    # time-major on purpose: each rollout step writes one contiguous num_envs row, and
+    # each step of the reverse GAE scan reads one
+    logprobs = torch.zeros((args.num_steps, args.num_envs), device=device)
+    rewards = torch.zeros((args.num_steps, args.num_envs), device=device)
+    dones = torch.zeros((args.num_steps, args.num_envs), device=device)
+    values = torch.zeros((args.num_steps, args.num_envs), device=device)
     invalid_action_masks = torch.zeros(
-        (args.num_steps, args.num_envs) + (envs.action_space.nvec.sum(),)
-    ).to(device)
+        (args.num_steps, args.num_envs) + (agent._nvec_sum,),
+        dtype=torch.bool,
+        device=device,
+    )
+    # flattened views of the rollout storage; they share memory with the buffers above,
+    # so they are built once and see every update's data
+    b_obs = obs.reshape((-1,) + envs.observation_space.shape)
+    b_logprobs = logprobs.reshape(-1)
+    b_actions = actions.reshape((-1,) + envs.action_space.shape)
+    b_values = values.reshape(-1)
+    b_invalid_action_masks = invalid_action_masks.reshape(
+        (-1, invalid_action_masks.shape[-1])
+    )
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
@@ -598,16 +751,21 @@ def main():
 
             # ALGO LOGIC: put action logic here
             with torch.no_grad():
-                values[step] = agent.get_value(obs[step]).flatten()
-                action, logproba, _, invalid_action_masks[step] = agent.get_action(
-                    obs[step]
-                )
+                (
+                    values[step],
+                    action,
+                    logproba,
+                    _,
+                    invalid_action_masks[step],
+                ) = agent.get_action_and_value(obs[step])
 
+            # TRY NOT TO MODIFY: execute the game and log data.
+            # the env steps on the wrapper's worker thread while this step's outputs are
+            # stored; the next forward needs the new obs, so it waits in step_wait
+            envs.step_async(action.T)
             actions[step] = action.T
             logprobs[step] = logproba
-
-            # TRY NOT TO MODIFY: execute the game and log data.
-            next_obs, rs, ds, infos = envs.step(action.T)
+            next_obs, rs, ds, infos = envs.step_wait()
             rewards[step], next_done = rs.view(-1), torch.Tensor(ds).to(device)
 
             for info in infos:
@@ -628,54 +786,31 @@ def main():
         with torch.no_grad():
             last_value = agent.get_value(next_obs.to(device)).reshape(1, -1)
             if args.gae:
-                advantages = torch.zeros_like(rewards).to(device)
-                lastgaelam = 0
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        nextvalues = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        nextvalues = values[t + 1]
-                    delta = (
-                        rewards[t]
-                        + args.gamma * nextvalues * nextnonterminal
-                        - values[t]
-                    )
-                    advantages[t] = lastgaelam = (
-                        delta
-                        + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                    )
-                returns = advantages + values
+                advantages, returns = compute_gae(
+                    rewards,
+                    values,
+                    dones,
+                    last_value,
+                    next_done,
+                    args.gamma,
+                    args.gae_lambda,
+                )
             else:
-                returns = torch.zeros_like(rewards).to(device)
-                for t in reversed(range(args.num_steps)):
-                    if t == args.num_steps - 1:
-                        nextnonterminal = 1.0 - next_done
-                        next_return = last_value
-                    else:
-                        nextnonterminal = 1.0 - dones[t + 1]
-                        next_return = returns[t + 1]
-                    returns[t] = rewards[t] + args.gamma * nextnonterminal * next_return
-                advantages = returns - values
+                advantages, returns = compute_returns(
+                    rewards, values, dones, last_value, next_done, args.gamma
+                )
 
         # flatten the batch
-        b_obs = obs.reshape((-1,) + envs.observation_space.shape)
-        b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + envs.action_space.shape)
         b_advantages = advantages.reshape(-1)
         b_returns = returns.reshape(-1)
-        b_values = values.reshape(-1)
-        b_invalid_action_masks = invalid_action_masks.reshape(
-            (-1, invalid_action_masks.shape[-1])
-        )
 
         # Update target_agent once per update
-        target_agent.load_state_dict(agent.state_dict())
+        if args.kle_rollback:
+            target_agent.load_state_dict(agent.state_dict())
 
-        inds = np.arange(args.batch_size)
         for i_epoch_pi in range(args.update_epochs):
-            np.random.shuffle(inds)
+            # shuffled on the device, so the minibatch gathers never upload an index
+            inds = torch.randperm(args.batch_size, device=device)
             for start in range(0, args.batch_size, args.minibatch_size):
                 end = start + args.minibatch_size
                 minibatch_ind = inds[start:end]
@@ -685,15 +820,15 @@ def main():
                         mb_advantages.std() + 1e-8
                     )
 
-                _, newlogproba, entropy, _ = agent.get_action(
+                new_values, _, newlogproba, entropy, _ = agent.get_action_and_value(
                     b_obs[minibatch_ind],
-                    b_actions.long()[minibatch_ind].T,
+                    b_actions[minibatch_ind].long().T,
                     b_invalid_action_masks[minibatch_ind],
                 )
                 ratio = (newlogproba - b_logprobs[minibatch_ind]).exp()
 
-                # Stats
-                approx_kl = (b_logprobs[minibatch_ind] - newlogproba).mean()
+                # Stats (kept on the device; read back only by kle_stop and the logging)
+                approx_kl = (b_logprobs[minibatch_ind] - newlogproba.detach()).mean()
 
                 # Policy loss
                 pg_loss1 = -mb_advantages * ratio
@@ -704,7 +839,6 @@ def main():
                 entropy_loss = entropy.mean()
 
                 # Value loss
-                new_values = agent.get_value(b_obs[minibatch_ind]).view(-1)
                 if args.clip_vloss:
                     v_loss_unclipped = (new_values - b_returns[minibatch_ind]) ** 2
                     v_clipped = b_values[minibatch_ind] + torch.clamp(
@@ -716,7 +850,7 @@ def main():
                     v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
                     v_loss = 0.5 * v_loss_max.mean()
                 else:
-                    v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2)
+                    v_loss = 0.5 * ((new_values - b_returns[minibatch_ind]) ** 2).mean()
 
                 loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
 
@@ -732,9 +866,8 @@ def main():
                     b_logprobs[minibatch_ind]
                     - agent.get_action(
                         b_obs[minibatch_ind],
-                        b_actions.long()[minibatch_ind].T,
+                        b_actions[minibatch_ind].long().T,
                         b_invalid_action_masks[minibatch_ind],
-                        envs,
                     )[1]
                 ).mean()
                 if kl_rollback > args.target_kl:
@@ -757,30 +890,34 @@ def main():
                     break
 
         ## CRASH AND RESUME LOGIC:
+        # (models/{experiment_name} is created once in set_environment)
         if args.prod_mode:
-            if not os.path.exists(f"models/{experiment_name}"):
-                os.makedirs(f"models/{experiment_name}")
+            if update == starting_update:
                 torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
                 wandb.save(f"agent.pt")
-            else:
-                if update % CHECKPOINT_FREQUENCY == 0:
-                    torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
+            elif update % CHECKPOINT_FREQUENCY == 0:
+                torch.save(agent.state_dict(), f"{wandb.run.dir}/agent.pt")
 
         # TRY NOT TO MODIFY: record rewards for plotting purposes
-        writer.add_scalar(
-            "charts/learning_rate", optimizer.param_groups[0]["lr"], global_step
+        # one device-to-host sync for all of the logged losses
+        value_loss, policy_loss, entropy_mean, approx_kl = (
+            torch.stack([v_loss, pg_loss, entropy.mean(), approx_kl]).detach().tolist()
         )
-        writer.add_scalar("charts/update", update, global_step)
-        writer.add_scalar("losses/value_loss", v_loss.item(), global_step)
-        writer.add_scalar("losses/policy_loss", pg_loss.item(), global_step)
-        writer.add_scalar("losses/entropy", entropy.mean().item(), global_step)
-        writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
+        sps = int(global_step / (time.time() - start_time))
+        stats = {
+            "charts/learning_rate": optimizer.param_groups[0]["lr"],
+            "charts/update": update,
+            "losses/value_loss": value_loss,
+            "losses/policy_loss": policy_loss,
+            "losses/entropy": entropy_mean,
+            "losses/approx_kl": approx_kl,
+            "charts/sps": sps,
+        }
         if args.kle_stop or args.kle_rollback:
-            writer.add_scalar("debug/pg_stop_iter", i_epoch_pi, global_step)
-        writer.add_scalar(
-            "charts/sps", int(global_step / (time.time() - start_time)), global_step
-        )
-        print("SPS:", int(global_step / (time.time() - start_time)))
+            stats["debug/pg_stop_iter"] = i_epoch_pi
+        for tag, value in stats.items():
+            writer.add_scalar(tag, value, global_step)
+        print("SPS:", sps)
 
         profiler.step()
 